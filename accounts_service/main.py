@@ -1,20 +1,18 @@
-from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi import FastAPI, Depends, HTTPException, Request, Query
 from fastapi.security import OAuth2PasswordBearer
-from starlette.middleware.base import BaseHTTPMiddleware
-from jose import jwt, JWTError
-from sqlalchemy.ext.asyncio import (
-    create_async_engine,
-    async_sessionmaker,
-    AsyncEngine,
-    AsyncSession,
-)
-from sqlalchemy import select
-from utils.config import settings
-from utils.db import get_db
+from jose import JWTError
+from cachetools import TTLCache
+from pydantic import TypeAdapter
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from utils.db import engine, get_db
 from utils.tracing import setup_tracing, shutdown_tracing
+from fastapi.responses import ORJSONResponse
 from utils.i18n import t, format_money
-from utils.idempotency import idempotency_middleware
-from utils.audit import audit_write
+from utils.idempotency import IdempotencyMiddleware
+from utils.audit import audit_write, setup_audit, shutdown_audit
+from utils.jwt_cache import decode_sub
 from utils.utils import get_lang
 from .models import Base, Account, AccountOperation
 from .schemas import (
@@ -28,11 +26,12 @@ import logging
 
 
 logger = logging.getLogger(__name__)
-DB_URL = settings.db_url
 
-engine: AsyncEngine = create_async_engine(DB_URL, echo=False, future=True)
-SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+ACCOUNT_LIST_ADAPTER = TypeAdapter(list[AccountOut])
+# client_key -> {"owner", "body"}: повторы без похода в БД
+# (источник истины — account_operations, кэш лишь срезает round-trip)
+_idem_cache: TTLCache = TTLCache(maxsize=50000, ttl=300)
 
 
 async def init_db():
@@ -51,10 +50,12 @@ async def lifespan(app: FastAPI):
     # startup
     setup_tracing(app, "accounts_service")
     await init_db()
+    await setup_audit()
     try:
         yield
     finally:
         # shutdown
+        await shutdown_audit()
         await close_db()
         try:
             shutdown_tracing()
@@ -62,19 +63,17 @@ async def lifespan(app: FastAPI):
             logger.error(f"Ошибка при остановке трассировки: {e}")
 
 
-app = FastAPI(title="accounts_service", lifespan=lifespan)
-app.add_middleware(BaseHTTPMiddleware, dispatch=idempotency_middleware)
+app = FastAPI(
+    title="accounts_service",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+app.add_middleware(IdempotencyMiddleware)
 
 
 def get_current_user_email(token: str = Depends(oauth2_scheme)) -> str:
     try:
-        logger.info(
-            f"[accounts] JWT_SECRET_LEN={len(settings.jwt_secret)} ALG={settings.jwt_alg}"
-        )
-        payload = jwt.decode(
-            token, settings.jwt_secret, algorithms=[settings.jwt_alg]
-        )
-        sub = payload.get("sub")
+        sub = decode_sub(token)
         if not sub:
             raise ValueError
         return sub
@@ -111,12 +110,30 @@ async def create_account(
 
 @app.get("/accounts", response_model=list[AccountOut])
 async def list_accounts(
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
     user: str = Depends(get_current_user_email),
     db: AsyncSession = Depends(get_db),
 ):
-    q = await db.execute(select(Account).where(Account.owner_email == user))
-    items = q.scalars().all()
-    return items
+    # только нужные AccountOut колонки, постранично
+    q = await db.execute(
+        select(Account.id, Account.currency, Account.balance, Account.title)
+        .where(Account.owner_email == user)
+        .order_by(Account.id)
+        .limit(limit)
+        .offset(offset)
+    )
+    items = [
+        AccountOut(
+            id=row.id,
+            currency=row.currency,
+            balance=row.balance,
+            title=row.title,
+        )
+        for row in q
+    ]
+    # готовый Response: FastAPI не валидирует список повторно
+    return ORJSONResponse(ACCOUNT_LIST_ADAPTER.dump_python(items, mode="json"))
 
 
 @app.get("/accounts/{account_id}")
@@ -146,16 +163,65 @@ async def account_detail(
             status_code=404, detail=t("account_not_found", lang)
         )
     # демонстрация локализации денег
-    pretty_balance = format_money(float(acc.balance), acc.currency, lang)
+    pretty_balance = format_money(acc.balance, acc.currency, lang)
     return {
         "id": acc.id,
         "currency": acc.currency,
-        "balance": float(acc.balance),
+        "balance": acc.balance,
         "title": acc.title,
         "balance_pretty": pretty_balance,
     }
 
 
+def _is_client_key_conflict(e: IntegrityError) -> bool:
+    # только UNIQUE по client_key считается повтором; в тексте ошибки
+    # колонка есть и у SQLite (account_operations.client_key),
+    # и у Postgres (account_operations_client_key_key)
+    return "client_key" in str(e.orig)
+
+
+def _cached_balance_change(
+    account_id: int, client_key: str | None, user: str, operation: str
+) -> dict | None:
+    cached = _idem_cache.get(client_key) if client_key else None
+    if (
+        cached
+        and cached["owner"] == user
+        and cached["body"]["account_id"] == account_id
+        and cached["body"]["operation"] == operation
+    ):
+        return cached["body"]
+    return None
+
+
+async def _replay_balance_change(
+    db: AsyncSession,
+    account_id: int,
+    client_key: str,
+    user: str,
+    operation: str,
+) -> BalanceChangeOut | None:
+    # счёт и прошлая операция по client_key — одним запросом
+    q = await db.execute(
+        select(Account, AccountOperation)
+        .join(AccountOperation, AccountOperation.account_id == Account.id)
+        .where(
+            AccountOperation.client_key == client_key,
+            AccountOperation.operation == operation,
+            Account.id == account_id,
+        )
+    )
+    prev = q.first()
+    if not prev:
+        return None
+    acc, _ = prev
+    if acc.owner_email != user:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return BalanceChangeOut(
+        account_id=acc.id, balance=acc.balance, operation=operation
+    )
+
+
 @app.post("/accounts/{account_id}/deposit", response_model=BalanceChangeOut)
 async def deposit_to_account(
     account_id: int,
@@ -163,61 +229,79 @@ async def deposit_to_account(
     user: str = Depends(get_current_user_email),
     db: AsyncSession = Depends(get_db),
 ):
-    # идемпотентность: если пришёл client_key — проверим, выполняли ли уже
-    if payload.client_key:
-        q = await db.execute(
-            select(AccountOperation).where(
-                AccountOperation.client_key == payload.client_key
-            )
-        )
-        op_prev = q.scalar_one_or_none()
-        if op_prev:
-            acc = await db.get(Account, account_id)
-            if not acc or acc.owner_email != user:
-                raise HTTPException(status_code=403, detail="Forbidden")
-            return BalanceChangeOut(
-                account_id=acc.id,
-                balance=float(acc.balance),
-                operation="deposit",
-            )
+    body = _cached_balance_change(
+        account_id, payload.client_key, user, "deposit"
+    )
+    if body is not None:
+        return ORJSONResponse(body)
 
-    acc = await db.get(Account, account_id)
-    if not acc:
+    # атомарно: UPDATE ... RETURNING вместо чтения/записи в Python
+    amount = payload.amount
+    q = await db.execute(
+        update(Account)
+        .where(Account.id == account_id, Account.owner_email == user)
+        .values(balance=Account.balance + amount)
+        .returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    )
+    balance = q.scalar_one_or_none()
+    if balance is None:
         audit_write(
             user,
             "account_deposit",
             f"account:{account_id}",
-            {"amount": payload.amount},
+            {"amount": float(amount)},
             "fail",
             "not_found",
         )
         raise HTTPException(status_code=404, detail="Account not found")
 
-    if acc.owner_email != user:
-        raise HTTPException(status_code=403, detail="Forbidden")
-
-    # атомарность в рамках транзакции БД
-    acc.balance = float(acc.balance) + float(payload.amount)
     op = AccountOperation(
-        account_id=acc.id,
+        account_id=account_id,
         operation="deposit",
-        amount=float(payload.amount),
+        amount=amount,
         client_key=payload.client_key,
     )
     db.add(op)
-    await db.commit()
-    await db.refresh(acc)
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if payload.client_key and _is_client_key_conflict(e):
+            # client_key уже использован — это повтор запроса
+            prev = await _replay_balance_change(
+                db, account_id, payload.client_key, user, "deposit"
+            )
+            if prev is None:
+                raise HTTPException(
+                    status_code=409, detail="client_key already used"
+                )
+            return prev
+        audit_write(
+            user,
+            "account_deposit",
+            f"account:{account_id}",
+            {"amount": float(amount)},
+            "fail",
+            str(e.orig),
+        )
+        raise HTTPException(status_code=500, detail="Deposit failed")
+
     audit_write(
         user,
         "account_deposit",
-        f"account:{acc.id}",
-        {"amount": float(payload.amount)},
+        f"account:{account_id}",
+        {"amount": float(amount)},
         "success",
         None,
     )
-    return BalanceChangeOut(
-        account_id=acc.id, balance=float(acc.balance), operation="deposit"
+    out = BalanceChangeOut(
+        account_id=account_id, balance=balance, operation="deposit"
     )
+    body = out.model_dump(mode="json")
+    if payload.client_key:
+        _idem_cache[payload.client_key] = {"owner": user, "body": body}
+    return ORJSONResponse(body)
 
 
 @app.post("/accounts/{account_id}/withdraw", response_model=BalanceChangeOut)
@@ -227,69 +311,103 @@ async def withdraw_from_account(
     user: str = Depends(get_current_user_email),
     db: AsyncSession = Depends(get_db),
 ):
-    # идемпотентность
-    if payload.client_key:
+    body = _cached_balance_change(
+        account_id, payload.client_key, user, "withdraw"
+    )
+    if body is not None:
+        return ORJSONResponse(body)
+
+    # атомарно: достаточность средств проверяет сама БД в WHERE
+    amount = payload.amount
+    q = await db.execute(
+        update(Account)
+        .where(
+            Account.id == account_id,
+            Account.owner_email == user,
+            Account.balance >= amount,
+        )
+        .values(balance=Account.balance - amount)
+        .returning(Account.balance)
+        .execution_options(synchronize_session=False)
+    )
+    balance = q.scalar_one_or_none()
+    if balance is None:
+        # повтор уже выполненного списания мог упереться в остаток
+        if payload.client_key:
+            prev = await _replay_balance_change(
+                db, account_id, payload.client_key, user, "withdraw"
+            )
+            if prev is not None:
+                return prev
         q = await db.execute(
-            select(AccountOperation).where(
-                AccountOperation.client_key == payload.client_key
+            select(Account.balance).where(
+                Account.id == account_id, Account.owner_email == user
             )
         )
-        op_prev = q.scalar_one_or_none()
-        if op_prev:
-            acc = await db.get(Account, account_id)
-            if not acc or acc.owner_email != user:
-                raise HTTPException(status_code=403, detail="Forbidden")
-            return BalanceChangeOut(
-                account_id=acc.id,
-                balance=float(acc.balance),
-                operation="withdraw",
+        have = q.scalar_one_or_none()
+        if have is None:
+            audit_write(
+                user,
+                "account_withdraw",
+                f"account:{account_id}",
+                {"amount": float(amount)},
+                "fail",
+                "not_found",
             )
-
-    acc = await db.get(Account, account_id)
-    if not acc:
+            raise HTTPException(status_code=404, detail="Account not found")
         audit_write(
             user,
             "account_withdraw",
             f"account:{account_id}",
-            {"amount": payload.amount},
-            "fail",
-            "not_found",
-        )
-        raise HTTPException(status_code=404, detail="Account not found")
-
-    if acc.owner_email != user:
-        raise HTTPException(status_code=403, detail="Forbidden")
-
-    amount = float(payload.amount)
-    if float(acc.balance) < amount:
-        audit_write(
-            user,
-            "account_withdraw",
-            f"account:{acc.id}",
-            {"need": amount, "have": float(acc.balance)},
+            {"need": float(amount), "have": float(have)},
             "fail",
             "insufficient_funds",
         )
         raise HTTPException(status_code=400, detail="Insufficient funds")
 
-    acc.balance = float(acc.balance) - amount
     op = AccountOperation(
-        account_id=acc.id,
+        account_id=account_id,
         operation="withdraw",
         amount=amount,
         client_key=payload.client_key,
     )
     db.add(op)
-    await db.commit()
-    await db.refresh(acc)
+    try:
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if payload.client_key and _is_client_key_conflict(e):
+            # client_key уже использован — это повтор запроса
+            prev = await _replay_balance_change(
+                db, account_id, payload.client_key, user, "withdraw"
+            )
+            if prev is None:
+                raise HTTPException(
+                    status_code=409, detail="client_key already used"
+                )
+            return prev
+        audit_write(
+            user,
+            "account_withdraw",
+            f"account:{account_id}",
+            {"amount": float(amount)},
+            "fail",
+            str(e.orig),
+        )
+        raise HTTPException(status_code=500, detail="Withdraw failed")
+
     audit_write(
         user,
         "account_withdraw",
-        f"account:{acc.id}",
-        {"amount": amount},
+        f"account:{account_id}",
+        {"amount": float(amount)},
         "success",
         None,
     )
-    return BalanceChangeOut(
-        account_id=acc.id, balance=float(acc.balance), operation="withdraw"
+    out = BalanceChangeOut(
+        account_id=account_id, balance=balance, operation="withdraw"
     )
+    body = out.model_dump(mode="json")
+    if payload.client_key:
+        _idem_cache[payload.client_key] = {"owner": user, "body": body}
+    return ORJSONResponse(body)
@@ -1,5 +1,13 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Numeric, Integer, DateTime, ForeignKey
+from sqlalchemy import (
+    String,
+    Numeric,
+    Integer,
+    DateTime,
+    ForeignKey,
+    Index,
+    func,
+)
 from typing import Optional
 from datetime import datetime
 
@@ -10,6 +18,7 @@ class Base(DeclarativeBase):
 
 class Account(Base):
     __tablename__ = "accounts"
+    __table_args__ = (Index("ix_accounts_owner_id", "owner_email", "id"),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     owner_email: Mapped[str] = mapped_column(String(255), index=True)
     currency: Mapped[str] = mapped_column(String(10), index=True)
@@ -28,6 +37,12 @@ class AccountOperation(Base):
     client_key: Mapped[str | None] = mapped_column(
         String(64), unique=True, nullable=True
     )
+    # время ставит БД: default рендерится в INSERT как now() без
+    # параметра (нужно для таблиц, созданных без DEFAULT — миграций нет),
+    # server_default — для новых таблиц
     created_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow
+        DateTime(timezone=True),
+        default=func.now(),
+        server_default=func.now(),
+        nullable=False,
     )
@@ -1,4 +1,11 @@
-from pydantic import BaseModel, Field
+from decimal import Decimal
+from typing import Annotated
+from pydantic import BaseModel, ConfigDict, Field, PlainSerializer
+
+# внутри — Decimal, в JSON — число, как и balance в AccountOut
+JsonMoney = Annotated[
+    Decimal, PlainSerializer(float, return_type=float, when_used="json")
+]
 
 
 class AccountCreate(BaseModel):
@@ -12,12 +19,13 @@ class AccountOut(BaseModel):
     balance: float
     title: str | None = None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class BalanceChangeIn(BaseModel):
-    amount: float = Field(gt=0, description="Сумма > 0")
+    amount: Decimal = Field(
+        gt=0, max_digits=18, decimal_places=2, description="Сумма > 0"
+    )
     client_key: str | None = Field(
         default=None, description="Идемпотентный ключ клиента"
     )
@@ -25,5 +33,5 @@ class BalanceChangeIn(BaseModel):
 
 class BalanceChangeOut(BaseModel):
     account_id: int
-    balance: float
+    balance: JsonMoney
     operation: str
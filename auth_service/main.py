@@ -2,22 +2,22 @@ from fastapi import HTTPException, Request
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends
 from utils.tracing import setup_tracing, shutdown_tracing
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt, JWTError
-from sqlalchemy.ext.asyncio import (
-    create_async_engine,
-    async_sessionmaker,
-    AsyncSession,
-    AsyncEngine,
-)
+from jose import JWTError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from starlette.middleware.base import BaseHTTPMiddleware
-from utils.config import settings
-from utils.db import get_db
+from sqlalchemy.exc import IntegrityError
+from utils.db import engine, get_db
 from utils.i18n import t
-from utils.security import hash_password, verify_password, create_access_token
-from utils.idempotency import idempotency_middleware
-from utils.audit import audit_write
+from utils.security import (
+    hash_password,
+    verify_password_cached,
+    create_access_token,
+)
+from utils.idempotency import IdempotencyMiddleware
+from utils.audit import audit_write, setup_audit, shutdown_audit
+from utils.jwt_cache import decode_sub
 from utils.utils import get_lang
 from .models import Base, User
 from .schemas import RegisterIn, LoginIn, TokenOut
@@ -26,10 +26,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-DB_URL = settings.db_url
 
-engine: AsyncEngine = create_async_engine(DB_URL, echo=False, future=True)
-SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
 
 
@@ -47,9 +44,11 @@ async def lifespan(app: FastAPI):
     # startup
     setup_tracing(app, "auth_service")
     await init_db()
+    await setup_audit()
     try:
         yield
     finally:
+        await shutdown_audit()
         await close_db()
         try:
             shutdown_tracing()
@@ -57,19 +56,17 @@ async def lifespan(app: FastAPI):
             logger.error(f"Ошибка при остановке трассировки: {e}")
 
 
-app = FastAPI(title="auth_service", lifespan=lifespan)
-app.add_middleware(BaseHTTPMiddleware, dispatch=idempotency_middleware)
+app = FastAPI(
+    title="auth_service",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+app.add_middleware(IdempotencyMiddleware)
 
 
 def get_current_user_id(token: str = Depends(oauth2_scheme)) -> str:
     try:
-        payload = jwt.decode(
-            token, settings.jwt_secret, algorithms=[settings.jwt_alg]
-        )
-        logger.info(
-            f"[auth] JWT_SECRET_LEN={len(settings.jwt_secret)} ALG={settings.jwt_alg}"
-        )
-        sub = payload.get("sub")
+        sub = decode_sub(token)
         if not sub:
             raise ValueError
         return sub
@@ -84,10 +81,17 @@ async def register(
 ):
     lang = get_lang(request)
 
-    # проверка существования
-    q = await db.execute(select(User).where(User.email == data.email))
-    existing = q.scalar_one_or_none()
-    if existing:
+    # существование проверяет UNIQUE(email): один запрос на обычном пути
+    user = User(
+        email=data.email,
+        password_hash=hash_password(data.password),
+        full_name=data.full_name,
+    )
+    db.add(user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
         audit_write(
             None,
             "register",
@@ -98,13 +102,6 @@ async def register(
         )
         raise HTTPException(status_code=400, detail=t("user_exists", lang))
 
-    user = User(
-        email=data.email,
-        password_hash=hash_password(data.password),
-        full_name=data.full_name,
-    )
-    db.add(user)
-    await db.commit()
     token = create_access_token(sub=user.email)
     audit_write(
         user.email,
@@ -125,7 +122,9 @@ async def login(
 
     q = await db.execute(select(User).where(User.email == data.email))
     user = q.scalar_one_or_none()
-    if not user or not verify_password(data.password, user.password_hash):
+    if not user or not verify_password_cached(
+        data.email, data.password, user.password_hash
+    ):
         audit_write(
             None,
             "login",
@@ -0,0 +1,79 @@
+import asyncio
+import pytest
+
+from notifications_service import worker
+
+
+class FakeMessage:
+    def __init__(self, n: int):
+        self.body = f"msg-{n}".encode()
+        self.acks: list[dict] = []
+        self.nacks: list[dict] = []
+
+    async def ack(self, multiple: bool = False) -> None:
+        self.acks.append({"multiple": multiple})
+
+    async def nack(
+        self, multiple: bool = False, requeue: bool = True
+    ) -> None:
+        self.nacks.append({"multiple": multiple, "requeue": requeue})
+
+
+def fill(inbox: asyncio.Queue, start: int, count: int) -> list[FakeMessage]:
+    msgs = [FakeMessage(n) for n in range(start, start + count)]
+    for m in msgs:
+        inbox.put_nowait(m)
+    return msgs
+
+
+@pytest.mark.asyncio
+async def test_next_batch_full_then_partial_by_timeout():
+    inbox: asyncio.Queue = asyncio.Queue()
+    msgs = fill(inbox, 0, worker.BATCH_SIZE + 5)
+
+    # полная пачка — сразу, без ожидания BATCH_WAIT
+    batch = await worker.next_batch(inbox)
+    assert batch == msgs[: worker.BATCH_SIZE]
+
+    # остаток — неполная пачка, закрывается по таймауту
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    batch = await worker.next_batch(inbox)
+    elapsed = loop.time() - started
+    assert batch == msgs[worker.BATCH_SIZE :]
+    assert worker.BATCH_WAIT * 0.9 <= elapsed < worker.BATCH_WAIT + 0.5
+
+
+@pytest.mark.asyncio
+async def test_consume_batches_nacks_failed_batch_and_keeps_going(
+    monkeypatch,
+):
+    seen: list[list[str]] = []
+    done = asyncio.Event()
+
+    async def handle_batch(bodies: list[str]) -> None:
+        seen.append(bodies)
+        if len(seen) == 1:
+            raise RuntimeError("boom")
+        done.set()
+
+    monkeypatch.setattr(worker, "handle_batch", handle_batch)
+    inbox: asyncio.Queue = asyncio.Queue()
+    consumer = asyncio.create_task(worker.consume_batches(inbox))
+    try:
+        failed = fill(inbox, 0, 3)
+        while len(seen) < 1:
+            await asyncio.sleep(0.01)
+        ok = fill(inbox, 3, 2)
+        await asyncio.wait_for(done.wait(), timeout=2)
+    finally:
+        consumer.cancel()
+
+    assert seen == [["msg-0", "msg-1", "msg-2"], ["msg-3", "msg-4"]]
+    # упавшая пачка — один nack на последнем сообщении, без requeue
+    assert failed[-1].nacks == [{"multiple": True, "requeue": False}]
+    assert all(not m.acks for m in failed)
+    assert all(not m.nacks for m in failed[:-1])
+    # следующая пачка подтверждена одним ack(multiple=True)
+    assert ok[-1].acks == [{"multiple": True}]
+    assert not ok[0].acks and not ok[0].nacks
@@ -1,18 +1,18 @@
 # 0) Сначала — среда для всех сервисов (до импортов приложений!)
 import os
-from pathlib import Path
+import tempfile
 
 # Отключить Jaeger/OTEL, чтобы не сыпались ошибки экспорта
 os.environ["OTEL_SDK_DISABLED"] = "true"
 
-# Единый временный файл БД для всех сервисов
-BASE_DIR = Path(__file__).resolve().parents[1]  # .../money_transfer
-TEST_DB_PATH = BASE_DIR / "test_app.sqlite3"
-if TEST_DB_PATH.exists():
-    TEST_DB_PATH.unlink()  # чистый старт
-
-os.environ["DB_URL"] = f"sqlite+aiosqlite:///{TEST_DB_PATH.as_posix()}"
+# Единая БД в памяти (shared cache) для всех сервисов: без файла и fsync,
+# живёт, пока открыто хоть одно соединение
+os.environ[
+    "DB_URL"
+] = "sqlite+aiosqlite:///file:memdb1?mode=memory&cache=shared&uri=true"
 os.environ["USE_MOCK_RATES"] = "true"
+# SQLite аудита — во временный каталог, а не в дерево репозитория
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="audit_")
 
 # Один и тот же JWT_SECRET и нормальный TTL
 os.environ[
@@ -26,10 +26,13 @@ import pytest
 from decimal import Decimal
 from httpx import AsyncClient, ASGITransport
 from asgi_lifespan import LifespanManager
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # ASGI-приложения
 from auth_service.main import app as auth_app
 from accounts_service.main import app as accounts_app
+from accounts_service import main as accounts_main
 from transactions_service.main import app as tx_app
 
 # 2) Жёстко фиксируем ожидания под твои МОКИ (540, 628, 1/540, 1/628)
@@ -46,7 +49,7 @@ def q2(x: Decimal) -> Decimal:
 
 
 @pytest.mark.asyncio
-async def test_full_flow():
+async def test_full_flow(monkeypatch):
     # Поднимаем lifespan у всех трёх приложений на время теста
     async with LifespanManager(auth_app), LifespanManager(
         accounts_app
@@ -55,12 +58,19 @@ async def test_full_flow():
         acc_tr = ASGITransport(app=accounts_app)
         tx_tr = ASGITransport(app=tx_app)
 
-        # ---------- 1) Регистрация/логин ----------
-        email = f"u_{uuid.uuid4().hex[:8]}@test.com"
-        password = "pw12345678"
+        # по одному клиенту на сервис на весь сценарий
+        async with AsyncClient(
+            transport=auth_tr, base_url="http://test"
+        ) as auth_c, AsyncClient(
+            transport=acc_tr, base_url="http://test"
+        ) as acc_c, AsyncClient(
+            transport=tx_tr, base_url="http://test"
+        ) as tx_c:
+            # ---------- 1) Регистрация/логин ----------
+            email = f"u_{uuid.uuid4().hex[:8]}@test.com"
+            password = "pw12345678"
 
-        async with AsyncClient(transport=auth_tr, base_url="http://test") as c:
-            r = await c.post(
+            r = await auth_c.post(
                 "/register",
                 json={
                     "email": email,
@@ -69,62 +79,181 @@ async def test_full_flow():
                 },
             )
             assert r.status_code == 200, r.text
+            assert r.headers["X-Idempotency-Key"]
             token = r.json()["access_token"]
-            r = await c.get(
-                "/whoami", headers={"Authorization": f"Bearer {token}"}
+            # повторная регистрация того же email — 400
+            r = await auth_c.post(
+                "/register", json={"email": email, "password": password}
+            )
+            assert r.status_code == 400, r.text
+            # логин: верный пароль (дважды — второй раз из кэша), неверный
+            for _ in range(2):
+                r = await auth_c.post(
+                    "/login", json={"email": email, "password": password}
+                )
+                assert r.status_code == 200, r.text
+            r = await auth_c.post(
+                "/login", json={"email": email, "password": "wrong-pass"}
+            )
+            assert r.status_code == 401, r.text
+            r = await auth_c.get(
+                "/whoami",
+                headers={
+                    "Authorization": f"Bearer {token}",
+                    "X-Idempotency-Key": "idem-1",
+                },
             )
             assert r.status_code == 200
+            assert r.headers["X-Idempotency-Key"] == "idem-1"
             assert r.json()["user"] == email
 
-        headers = {"Authorization": f"Bearer {token}"}
+            headers = {"Authorization": f"Bearer {token}"}
 
-        # ---------- 2) Создание счетов ----------
-        async with AsyncClient(transport=acc_tr, base_url="http://test") as c:
-            r = await c.post(
+            # ---------- 2) Создание счетов ----------
+            r = await acc_c.post(
                 "/accounts", headers=headers, json={"currency": "USD"}
             )
             assert r.status_code == 200, r.text
             acc_usd = r.json()["id"]
 
-            r = await c.post(
+            r = await acc_c.post(
                 "/accounts", headers=headers, json={"currency": "KZT"}
             )
             assert r.status_code == 200, r.text
             acc_kzt = r.json()["id"]
 
-        # ---------- 3) Депозит USD: 200.00 ----------
-        async with AsyncClient(transport=acc_tr, base_url="http://test") as c:
-            r = await c.post(
+            r = await acc_c.get("/accounts", headers=headers)
+            assert [a["id"] for a in r.json()] == [acc_usd, acc_kzt]
+            # GET без ключа — middleware его не генерирует
+            assert "X-Idempotency-Key" not in r.headers
+            r = await acc_c.get(
+                "/accounts", headers=headers, params={"limit": 1, "offset": 1}
+            )
+            assert [a["id"] for a in r.json()] == [acc_kzt]
+
+            # ---------- 3) Депозит USD: 200.00 ----------
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/deposit",
+                headers=headers,
+                json={"amount": 200.0, "client_key": f"dep-{acc_usd}-200"},
+            )
+            assert r.status_code == 200, r.text
+            # баланс — JSON-число, как в GET /accounts
+            assert isinstance(r.json()["balance"], float)
+
+            # повтор с тем же client_key не должен пополнить второй раз
+            r = await acc_c.post(
                 f"/accounts/{acc_usd}/deposit",
                 headers=headers,
                 json={"amount": 200.0, "client_key": f"dep-{acc_usd}-200"},
             )
             assert r.status_code == 200, r.text
+            assert q2(Decimal(str(r.json()["balance"]))) == Decimal("200.00")
+
+            # повторы мимо in-process кэша: UNIQUE(client_key) в БД
+            dep_key = f"dep-{acc_usd}-200"
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/withdraw",
+                headers=headers,
+                json={"amount": 50.0, "client_key": f"wd-{acc_usd}-50"},
+            )
+            assert r.status_code == 200, r.text
+            assert q2(Decimal(str(r.json()["balance"]))) == Decimal("150.00")
+
+            accounts_main._idem_cache.clear()
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/deposit",
+                headers=headers,
+                json={"amount": 200.0, "client_key": dep_key},
+            )
+            assert r.status_code == 200, r.text
+            assert q2(Decimal(str(r.json()["balance"]))) == Decimal("150.00")
+
+            # повтор списания: и пока остатка хватает, и когда уже нет
+            for amount in (50.0, 1000.0):
+                accounts_main._idem_cache.clear()
+                r = await acc_c.post(
+                    f"/accounts/{acc_usd}/withdraw",
+                    headers=headers,
+                    json={"amount": amount, "client_key": f"wd-{acc_usd}-50"},
+                )
+                assert r.status_code == 200, r.text
+                balance = Decimal(str(r.json()["balance"]))
+                assert q2(balance) == Decimal("150.00")
+
+            # ключ пополнения для списания — 409, баланс откатывается
+            accounts_main._idem_cache.clear()
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/withdraw",
+                headers=headers,
+                json={"amount": 10.0, "client_key": dep_key},
+            )
+            assert r.status_code == 409, r.text
+
+            # IntegrityError не по client_key (и запрос без ключа) — это
+            # не повтор: 500, баланс откатывается
+            async def not_null_commit(self):
+                raise IntegrityError(
+                    "INSERT INTO account_operations ...",
+                    {},
+                    Exception("NOT NULL constraint failed: created_at"),
+                )
+
+            with monkeypatch.context() as m:
+                m.setattr(AsyncSession, "commit", not_null_commit)
+                for op, client_key in (
+                    ("deposit", None),
+                    ("withdraw", f"wd-{acc_usd}-10"),
+                ):
+                    r = await acc_c.post(
+                        f"/accounts/{acc_usd}/{op}",
+                        headers=headers,
+                        json={"amount": 10.0, "client_key": client_key},
+                    )
+                    assert r.status_code == 500, r.text
+            r = await acc_c.get(f"/accounts/{acc_usd}", headers=headers)
+            assert q2(Decimal(str(r.json()["balance"]))) == Decimal("150.00")
+
+            # возвращаем баланс к 200.00 для сценария переводов
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/deposit",
+                headers=headers,
+                json={"amount": 50.0, "client_key": f"dep-{acc_usd}-50"},
+            )
+            assert r.status_code == 200, r.text
+            assert q2(Decimal(str(r.json()["balance"]))) == Decimal("200.00")
+
+            # списание больше баланса — 400, баланс не меняется
+            r = await acc_c.post(
+                f"/accounts/{acc_usd}/withdraw",
+                headers=headers,
+                json={"amount": 1000.0},
+            )
+            assert r.status_code == 400, r.text
 
-            r = await c.get(f"/accounts/{acc_usd}", headers=headers)
+            r = await acc_c.get(f"/accounts/{acc_usd}", headers=headers)
             assert q2(Decimal(str(r.json()["balance"]))) == Decimal("200.00")
 
-            r = await c.get(f"/accounts/{acc_kzt}", headers=headers)
+            r = await acc_c.get(f"/accounts/{acc_kzt}", headers=headers)
             assert q2(Decimal(str(r.json()["balance"]))) == Decimal("0.00")
 
-        # ---------- 4) Перевод USD->KZT (mode="from", 100 USD, fee 1%) ----------
-        # ожидаем: 100 * 540 * (1 - 0.01) = 53 460.00
-        expected_kzt = q2(
-            Decimal("100")
-            * USD_TO_KZT
-            * (Decimal("1") - PERCENT / Decimal("100"))
-        )
-        payload1 = {
-            "from_account_id": acc_usd,
-            "to_account_id": acc_kzt,
-            "mode": "from",
-            "amount": 100.0,
-            "commission_percent": float(PERCENT),
-            "commission_fixed": float(FIXED),
-            "client_key": "demo-req-1",
-        }
-        async with AsyncClient(transport=tx_tr, base_url="http://test") as c:
-            r = await c.post("/transfers", headers=headers, json=payload1)
+            # ---------- 4) Перевод USD->KZT (mode="from", 100 USD, fee 1%) ----------
+            # ожидаем: 100 * 540 * (1 - 0.01) = 53 460.00
+            expected_kzt = q2(
+                Decimal("100")
+                * USD_TO_KZT
+                * (Decimal("1") - PERCENT / Decimal("100"))
+            )
+            payload1 = {
+                "from_account_id": acc_usd,
+                "to_account_id": acc_kzt,
+                "mode": "from",
+                "amount": 100.0,
+                "commission_percent": float(PERCENT),
+                "commission_fixed": float(FIXED),
+                "client_key": "demo-req-1",
+            }
+            r = await tx_c.post("/transfers", headers=headers, json=payload1)
             assert r.status_code == 200, r.text
             body = r.json()
             assert body["status"] == "completed"
@@ -133,32 +262,29 @@ async def test_full_flow():
                 q2(Decimal(str(body["amount_to"]))) == expected_kzt
             )  # 53460.00
 
-        # Балансы после перевода
-        async with AsyncClient(transport=acc_tr, base_url="http://test") as c:
-            r = await c.get(f"/accounts/{acc_usd}", headers=headers)
+            # Балансы после перевода
+            r = await acc_c.get(f"/accounts/{acc_usd}", headers=headers)
             assert q2(Decimal(str(r.json()["balance"]))) == Decimal("100.00")
-            r = await c.get(f"/accounts/{acc_kzt}", headers=headers)
+            r = await acc_c.get(f"/accounts/{acc_kzt}", headers=headers)
             assert q2(Decimal(str(r.json()["balance"]))) == expected_kzt
 
-        # ---------- 5) Идемпотентность (тот же client_key) ----------
-        async with AsyncClient(transport=tx_tr, base_url="http://test") as c:
-            r = await c.post("/transfers", headers=headers, json=payload1)
+            # ---------- 5) Идемпотентность (тот же client_key) ----------
+            r = await tx_c.post("/transfers", headers=headers, json=payload1)
             assert r.status_code == 200, r.text
             assert r.json()["id"] == t1_id
 
-        # ---------- 6) Перевод KZT->USD (mode="from", 10 000 KZT, fee 1%) ----------
-        # грязная сумма: 10000 * (1/540) ≈ 18.5185, комиссия 1% ≈ 0.1852 → 0.19, итог ≈ 18.33
-        payload2 = {
-            "from_account_id": acc_kzt,
-            "to_account_id": acc_usd,
-            "mode": "from",
-            "amount": 10000.0,
-            "commission_percent": float(PERCENT),
-            "commission_fixed": float(FIXED),
-            "client_key": "demo-req-2",
-        }
-        async with AsyncClient(transport=tx_tr, base_url="http://test") as c:
-            r = await c.post("/transfers", headers=headers, json=payload2)
+            # ---------- 6) Перевод KZT->USD (mode="from", 10 000 KZT, fee 1%) ----------
+            # грязная сумма: 10000 * (1/540) ≈ 18.5185, комиссия 1% ≈ 0.1852 → 0.19, итог ≈ 18.33
+            payload2 = {
+                "from_account_id": acc_kzt,
+                "to_account_id": acc_usd,
+                "mode": "from",
+                "amount": 10000.0,
+                "commission_percent": float(PERCENT),
+                "commission_fixed": float(FIXED),
+                "client_key": "demo-req-2",
+            }
+            r = await tx_c.post("/transfers", headers=headers, json=payload2)
             assert r.status_code == 200, r.text
             amt_to_usd = float(
                 Decimal(str(r.json()["amount_to"])).quantize(Q2)
@@ -172,24 +298,47 @@ async def test_full_flow():
                 float(expected_usd), rel=1e-3
             )  # ≈ 18.33
 
-        # ---------- 7) Перевод USD->KZT (mode="to", хотим ровно 20 000 KZT) ----------
-        expected_from = Decimal("20000") / (
-            USD_TO_KZT * (Decimal("1") - PERCENT / Decimal("100"))
-        )  # ≈ 37.43
-        payload3 = {
-            "from_account_id": acc_usd,
-            "to_account_id": acc_kzt,
-            "mode": "to",
-            "amount": 20000.0,
-            "commission_percent": float(PERCENT),
-            "commission_fixed": float(FIXED),
-            "client_key": "demo-req-3",
-        }
-        async with AsyncClient(transport=tx_tr, base_url="http://test") as c:
-            r = await c.post("/transfers", headers=headers, json=payload3)
+            # ---------- 7) Перевод USD->KZT (mode="to", хотим ровно 20 000 KZT) ----------
+            expected_from = Decimal("20000") / (
+                USD_TO_KZT * (Decimal("1") - PERCENT / Decimal("100"))
+            )  # ≈ 37.43
+            payload3 = {
+                "from_account_id": acc_usd,
+                "to_account_id": acc_kzt,
+                "mode": "to",
+                "amount": 20000.0,
+                "commission_percent": float(PERCENT),
+                "commission_fixed": float(FIXED),
+                "client_key": "demo-req-3",
+            }
+            r = await tx_c.post("/transfers", headers=headers, json=payload3)
             assert r.status_code == 200, r.text
             body = r.json()
             assert float(body["amount_to"]) == pytest.approx(20000.0, rel=1e-6)
             assert float(
                 Decimal(str(body["amount_from"])).quantize(Q2)
             ) == pytest.approx(float(q2(expected_from)), rel=1e-2)
+
+            # ---------- 8) Сбой commit: JSON 500, балансы не тронуты ----------
+            r = await acc_c.get(f"/accounts/{acc_usd}", headers=headers)
+            usd_before = r.json()["balance"]
+
+            async def failing_commit(self):
+                raise RuntimeError("commit failed")
+
+            with monkeypatch.context() as m:
+                m.setattr(AsyncSession, "commit", failing_commit)
+                r = await tx_c.post(
+                    "/transfers",
+                    headers=headers,
+                    json={
+                        **payload1,
+                        "amount": 10.0,
+                        "client_key": "demo-req-fail",
+                    },
+                )
+            assert r.status_code == 500, r.text
+            assert r.json() == {"detail": "Transfer failed"}
+
+            r = await acc_c.get(f"/accounts/{acc_usd}", headers=headers)
+            assert r.json()["balance"] == usd_before
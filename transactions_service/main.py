@@ -1,50 +1,64 @@
 import os
-import json
-from datetime import datetime
-from typing import cast, Optional
+import asyncio
+import orjson
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from types import MappingProxyType
+from typing import cast, Mapping, Optional
 from aio_pika import RobustConnection, Channel
 from aiormq import AMQPConnectionError
 from starlette.datastructures import State
 import httpx
-from jose import jwt, JWTError
+from cachetools import TTLCache
+from jose import JWTError
+from pydantic import TypeAdapter
 from fastapi import FastAPI, Depends, HTTPException, Request, Query
 from fastapi.security import OAuth2PasswordBearer
-from starlette.middleware.base import BaseHTTPMiddleware
 from sqlalchemy import select
-from sqlalchemy.ext.asyncio import (
-    create_async_engine,
-    async_sessionmaker,
-    AsyncSession,
-    AsyncEngine,
-)
+from sqlalchemy.ext.asyncio import AsyncSession
 from utils.config import settings
-from utils.db import get_db
+from utils.db import engine, get_db
 from utils.tracing import setup_tracing, shutdown_tracing
-from utils.idempotency import idempotency_middleware
-from utils.audit import audit_write
+from fastapi.responses import ORJSONResponse
+from utils.idempotency import IdempotencyMiddleware
+from utils.audit import audit_write, setup_audit, shutdown_audit
 from utils.i18n import t
+from utils.jwt_cache import decode_sub
 from .models import Base, Account, Transfer
 from .schemas import TransferCreate, TransferOut
-import asyncio
 import aio_pika
 from contextlib import asynccontextmanager
 import logging
 
 logger = logging.getLogger(__name__)
 
-DB_URL = settings.db_url
 RABBIT_URL = settings.rabbitmq_url
 QUEUE_NAME = "transfer_notifications"
 NOTIF_ENABLED = os.getenv("NOTIFICATIONS_ENABLED", "true").lower() == "true"
 
 
-DEFAULT_PERCENT = 1.0
-DEFAULT_FIXED = 0.0
+DEFAULT_PERCENT = Decimal("1.0")
+DEFAULT_FIXED = Decimal("0.0")
+CENT = Decimal("0.01")
 
 
-engine: AsyncEngine = create_async_engine(DB_URL, echo=False, future=True)
-SessionLocal = async_sessionmaker(engine, expire_on_commit=False)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+# сильные ссылки на фоновые publish — иначе задачу может собрать GC
+_publish_tasks: set[asyncio.Task] = set()
+TRANSFER_OUT_ADAPTER = TypeAdapter(TransferOut)
+
+
+# мок-курсы: таблица собирается один раз и только для чтения
+_MOCK_RATES: Mapping[tuple[str, str], float] = MappingProxyType(
+    {
+        ("USD", "KZT"): 540.00,
+        ("KZT", "USD"): 1 / 540.00,
+        ("EUR", "KZT"): 628.00,
+        ("KZT", "EUR"): 1 / 628.00,
+        ("EUR", "USD"): 1.162881,
+        ("USD", "EUR"): 1 / 1.162881,
+    }
+)
 
 
 class RatesProvider:
@@ -55,6 +69,23 @@ class RatesProvider:
     ):
         self.use_mock = use_mock
         self.provider_url = provider_url
+        # один клиент на процесс (keep-alive), создаётся при первом запросе
+        self._client: Optional[httpx.AsyncClient] = None
+        # курсы внутри минуты не меняются — не ходим к провайдеру каждый раз
+        self._rate_cache: TTLCache = TTLCache(maxsize=256, ttl=60)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=5,
+                limits=httpx.Limits(max_keepalive_connections=10),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
     async def get_rate(self, base: str, quote: str) -> float:
         base = base.upper()
@@ -62,24 +93,21 @@ class RatesProvider:
         if base == quote:
             return 1.0
         if self.use_mock:
-            table = {
-                ("USD", "KZT"): 540.00,
-                ("KZT", "USD"): 1 / 540.00,
-                ("EUR", "KZT"): 628.00,
-                ("KZT", "EUR"): 1 / 628.00,
-                ("EUR", "USD"): 1.162881,
-                ("USD", "EUR"): 1 / 1.162881,
-            }
-            return float(table.get((base, quote), 1.0))
+            rate = _MOCK_RATES.get((base, quote))
+            return rate if rate is not None else 1.0
+        key = (base, quote)
+        cached = self._rate_cache.get(key)
+        if cached is not None:
+            return cached
         url = f"{self.provider_url}?base={base}&symbols={quote}"
-        async with httpx.AsyncClient(timeout=5) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            data = r.json()
-            rate = data.get("rates", {}).get(quote)
-            if not rate:
-                raise ValueError("Rate not found")
-            return float(rate)
+        r = await self._get_client().get(url)
+        r.raise_for_status()
+        data = r.json()
+        rate = data.get("rates", {}).get(quote)
+        if not rate:
+            raise ValueError("Rate not found")
+        self._rate_cache[key] = float(rate)
+        return float(rate)
 
 
 rates = RatesProvider(
@@ -98,15 +126,13 @@ async def try_connect_rabbit(app: FastAPI) -> bool:
         logger.warning(
             "[rmq] Notifications disabled by NOTIFICATIONS_ENABLED=false"
         )
-        s.rmq_channel = None
-        s.rmq_connection = None
         return False
 
     try:
         conn: RobustConnection = await aio_pika.connect_robust(RABBIT_URL)
-        from aio_pika import Channel
-
-        ch: Channel = await conn.channel()
+        # без publisher confirms: publish не ждёт ack брокера,
+        # уведомления — fire-and-forget (потеря при падении брокера допустима)
+        ch: Channel = await conn.channel(publisher_confirms=False)
         await ch.declare_queue(QUEUE_NAME, durable=True)
         s.rmq_connection = conn
         s.rmq_channel = ch
@@ -118,15 +144,13 @@ async def try_connect_rabbit(app: FastAPI) -> bool:
         logger.warning(
             "[rmq] RabbitMQ unavailable: %s. Notifications will be NO-OP.", e
         )
-        s.rmq_channel = None
-        s.rmq_connection = None
         return False
 
 
 async def close_rabbit(app: FastAPI) -> None:
     s = _state(app)
-    ch: Optional[Channel] = getattr(s, "rmq_channel", None)
-    conn: Optional[RobustConnection] = getattr(s, "rmq_connection", None)
+    ch: Optional[Channel] = s.rmq_channel
+    conn: Optional[RobustConnection] = s.rmq_connection
     try:
         if ch and not ch.is_closed:
             await ch.close()
@@ -137,14 +161,27 @@ async def close_rabbit(app: FastAPI) -> None:
 
 async def publish_notification(app: FastAPI, payload: dict) -> None:
     s = _state(app)
-    ch: Optional[Channel] = getattr(s, "rmq_channel", None)
+    ch: Optional[Channel] = s.rmq_channel
     if not ch or ch.is_closed:
         logger.info("[rmq] NO-OP notify: %s", payload)
         return
-    await ch.default_exchange.publish(
-        aio_pika.Message(body=str(payload).encode("utf-8")),
-        routing_key=QUEUE_NAME,
-    )
+    try:
+        await ch.default_exchange.publish(
+            aio_pika.Message(
+                body=orjson.dumps(payload),
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=QUEUE_NAME,
+        )
+    except Exception as e:
+        audit_write(
+            payload.get("user"),
+            "notify_publish",
+            f"transfer:{payload.get('transfer_id')}",
+            {"error": str(e)},
+            "fail",
+            str(e),
+        )
 
 
 async def init_db() -> None:
@@ -160,28 +197,39 @@ async def close_db() -> None:
 async def lifespan(app: FastAPI):
     setup_tracing(app, "transactions_service")
     await init_db()
+    await setup_audit()
+    # атрибуты есть всегда — дальше читаем их напрямую, без getattr
+    s = _state(app)
+    s.rmq_channel = None
+    s.rmq_connection = None
     rmq_ok = await try_connect_rabbit(
         app
     )  # ← не падаем, если брокер недоступен
     try:
         yield
     finally:
+        # даём досланным уведомлениям шанс уйти до закрытия канала
+        if _publish_tasks:
+            await asyncio.wait(_publish_tasks, timeout=5)
         if rmq_ok:
             await close_rabbit(app)
+        await rates.aclose()
+        await shutdown_audit()
         await close_db()
         shutdown_tracing(app)
 
 
-app = FastAPI(title="transactions_service", lifespan=lifespan)
-app.add_middleware(BaseHTTPMiddleware, dispatch=idempotency_middleware)
+app = FastAPI(
+    title="transactions_service",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+app.add_middleware(IdempotencyMiddleware)
 
 
 def get_current_user_email(token: str = Depends(oauth2_scheme)) -> str:
     try:
-        payload = jwt.decode(
-            token, settings.jwt_secret, algorithms=[settings.jwt_alg]
-        )
-        sub = payload.get("sub")
+        sub = decode_sub(token)
         if not sub:
             raise ValueError
         return sub
@@ -189,52 +237,31 @@ def get_current_user_email(token: str = Depends(oauth2_scheme)) -> str:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
+def _cents(x: Decimal) -> Decimal:
+    return x.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
 def calc_from_mode(
-    amount_from: float, rate: float, p: float, f: float
-) -> tuple[float, float]:
+    amount_from: Decimal, rate: Decimal, p: Decimal, f: Decimal
+) -> tuple[Decimal, Decimal]:
     gross = amount_from * rate
-    commission = gross * (p / 100.0) + f
+    commission = gross * (p / 100) + f
     amount_to = gross - commission
     if amount_to <= 0:
         raise ValueError("Amount_to <= 0 after commission")
-    return round(amount_to, 2), round(commission, 2)
+    return _cents(amount_to), _cents(commission)
 
 
 def calc_to_mode(
-    amount_to_wanted: float, rate: float, p: float, f: float
-) -> tuple[float, float]:
-    percent_factor = 1.0 - (p / 100.0)
+    amount_to_wanted: Decimal, rate: Decimal, p: Decimal, f: Decimal
+) -> tuple[Decimal, Decimal]:
+    percent_factor = 1 - (p / 100)
     if percent_factor <= 0:
         raise ValueError("Invalid commission percent")
     gross_needed = (amount_to_wanted + f) / percent_factor
     amount_from_required = gross_needed / rate
     commission = gross_needed - amount_to_wanted
-    return round(amount_from_required, 2), round(commission, 2)
-
-
-async def publish_event(message: dict):
-    try:
-        connection = await aio_pika.connect_robust(RABBIT_URL)
-        async with connection:
-            channel = await connection.channel()
-            queue = await channel.declare_queue(QUEUE_NAME, durable=True)
-            await channel.default_exchange.publish(
-                aio_pika.Message(
-                    body=json.dumps(message, ensure_ascii=False).encode(
-                        "utf-8"
-                    )
-                ),
-                routing_key=queue.name,
-            )
-    except Exception as e:
-        audit_write(
-            message.get("user"),
-            "notify_publish",
-            f"transfer:{message.get('transfer_id')}",
-            {"error": str(e)},
-            "fail",
-            str(e),
-        )
+    return _cents(amount_from_required), _cents(commission)
 
 
 @app.post("/transfers", response_model=TransferOut)
@@ -245,21 +272,29 @@ async def create_transfer(
     db: AsyncSession = Depends(get_db),
 ):
     if payload.client_key:
-        q = await db.execute(
-            select(Transfer).where(Transfer.client_key == payload.client_key)
+        # сначала только id (обычно его нет), строку — лишь на повторе
+        prev_id = await db.scalar(
+            select(Transfer.id).where(
+                Transfer.client_key == payload.client_key
+            )
         )
-        prev = q.scalar_one_or_none()
-        if prev:
-            return TransferOut.model_validate(prev)
+        if prev_id is not None:
+            prev = await db.get(Transfer, prev_id)
+            return TRANSFER_OUT_ADAPTER.validate_python(
+                prev, from_attributes=True
+            )
 
-    q1 = await db.execute(
-        select(Account).where(Account.id == payload.from_account_id)
-    )
-    from_acc = q1.scalar_one_or_none()
-    q2 = await db.execute(
-        select(Account).where(Account.id == payload.to_account_id)
-    )
-    to_acc = q2.scalar_one_or_none()
+    # одно время на весь запрос: created_at/updated_at и записи аудита
+    now = datetime.now(timezone.utc)
+    ts = now.isoformat()
+
+    # оба счёта одним запросом, пока без блокировки: дальше может быть
+    # поход к провайдеру курсов, строки на это время не держим
+    ids = sorted({payload.from_account_id, payload.to_account_id})
+    q = await db.execute(select(Account).where(Account.id.in_(ids)))
+    by_id = {a.id: a for a in q.scalars()}
+    from_acc = by_id.get(payload.from_account_id)
+    to_acc = by_id.get(payload.to_account_id)
 
     if not from_acc or not to_acc:
         audit_write(
@@ -269,6 +304,7 @@ async def create_transfer(
             {},
             "fail",
             "account_not_found",
+            ts=ts,
         )
         raise HTTPException(
             status_code=404, detail=t("account_not_found", "ru")
@@ -278,33 +314,51 @@ async def create_transfer(
         raise HTTPException(status_code=403, detail="Forbidden")
 
     rate = await rates.get_rate(from_acc.currency, to_acc.currency)
+    # курс приходит float'ом — через str, чтобы не тащить двоичный хвост
+    rate_d = Decimal(str(rate))
 
-    p = float(
+    p = (
         payload.commission_percent
         if payload.commission_percent is not None
         else DEFAULT_PERCENT
     )
-    f = float(
+    f = (
         payload.commission_fixed
         if payload.commission_fixed is not None
         else DEFAULT_FIXED
     )
 
     if payload.mode == "from":
-        amount_from = float(payload.amount)
-        amount_to, commission_amount = calc_from_mode(amount_from, rate, p, f)
+        amount_from = payload.amount
+        amount_to, commission_amount = calc_from_mode(
+            amount_from, rate_d, p, f
+        )
     else:
-        amount_to = float(payload.amount)
-        amount_from, commission_amount = calc_to_mode(amount_to, rate, p, f)
+        amount_to = payload.amount
+        amount_from, commission_amount = calc_to_mode(
+            amount_to, rate_d, p, f
+        )
 
-    if float(from_acc.balance) < amount_from:
+    # курс известен — теперь блокируем строки до commit и перечитываем
+    # балансы: параллельный перевод с того же счёта ждёт, а не списывает
+    # дважды; порядок по id одинаков у всех, поэтому взаимных блокировок нет
+    await db.execute(
+        select(Account)
+        .where(Account.id.in_(ids))
+        .order_by(Account.id)
+        .with_for_update()
+        .execution_options(populate_existing=True)
+    )
+
+    if from_acc.balance < amount_from:
         audit_write(
             user,
             "transfer_create",
             f"account:{from_acc.id}",
-            {"need": amount_from, "have": float(from_acc.balance)},
+            {"need": float(amount_from), "have": float(from_acc.balance)},
             "fail",
             "insufficient_funds",
+            ts=ts,
         )
         raise HTTPException(
             status_code=400, detail=t("insufficient_funds", "ru")
@@ -320,79 +374,75 @@ async def create_transfer(
         commission_percent=p,
         commission_fixed=f,
         commission_amount=commission_amount,
-        rate_used=rate,
-        status="created",
+        rate_used=rate_d,
+        status="completed",
         client_key=payload.client_key,
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow(),
+        created_at=now,
+        updated_at=now,
     )
-    db.add(transfer)
-    await db.flush()
 
+    # перевод и оба баланса — одна транзакция, один commit;
+    # промежуточные статусы никто не видит, поэтому их не пишем
     try:
-        transfer.status = "processing"
-        await db.flush()
-
-        from_acc.balance = float(from_acc.balance) - amount_from
-        to_acc.balance = float(to_acc.balance) + amount_to
-        await db.flush()
-
-        transfer.status = "completed"
-        transfer.updated_at = datetime.utcnow()
+        db.add(transfer)
+        from_acc.balance = from_acc.balance - amount_from
+        to_acc.balance = to_acc.balance + amount_to
         await db.commit()
-
-        asyncio.create_task(
-            publish_event(
-                {
-                    "type": "transfer_completed",
-                    "transfer_id": transfer.id,
-                    "from": transfer.from_account_id,
-                    "to": transfer.to_account_id,
-                    "amount_from": float(transfer.amount_from),
-                    "currency_from": transfer.currency_from,
-                    "amount_to": float(transfer.amount_to),
-                    "currency_to": transfer.currency_to,
-                    "status": transfer.status,
-                    "user": user,
-                }
-            )
-        )
-
-        audit_write(
-            user,
-            "transfer_completed",
-            f"transfer:{transfer.id}",
-            {
-                "from": transfer.from_account_id,
-                "to": transfer.to_account_id,
-                "amount_from": amount_from,
-                "amount_to": amount_to,
-                "rate": rate,
-                "commission": commission_amount,
-            },
-            "success",
-            None,
-        )
-
     except Exception as e:
+        # rollback экспирирует from_acc/to_acc — их атрибуты больше не
+        # читаем (ленивый refresh в AsyncSession падает), берём id из запроса
         await db.rollback()
-        async with SessionLocal() as s2:
-            async with s2.begin():
-                t2 = await s2.get(Transfer, transfer.id)
-                if t2:
-                    t2.status = "failed"
-                    t2.updated_at = datetime.utcnow()
         audit_write(
             user,
             "transfer_failed",
-            f"transfer:{transfer.id}",
+            f"accounts:{payload.from_account_id}->{payload.to_account_id}",
             {"error": str(e)},
             "fail",
             str(e),
+            ts=ts,
         )
         raise HTTPException(status_code=500, detail="Transfer failed")
 
-    return TransferOut.model_validate(transfer)
+    # publish вне пути ответа: RobustChannel ждёт готовности соединения,
+    # и при переподключении к брокеру ответ на перевод не должен висеть
+    task = asyncio.create_task(
+        publish_notification(
+            request.app,
+            {
+                "type": "transfer_completed",
+                "transfer_id": transfer.id,
+                "from": transfer.from_account_id,
+                "to": transfer.to_account_id,
+                "amount_from": float(transfer.amount_from),
+                "currency_from": transfer.currency_from,
+                "amount_to": float(transfer.amount_to),
+                "currency_to": transfer.currency_to,
+                "status": transfer.status,
+                "user": user,
+            },
+        )
+    )
+    _publish_tasks.add(task)
+    task.add_done_callback(_publish_tasks.discard)
+
+    audit_write(
+        user,
+        "transfer_completed",
+        f"transfer:{transfer.id}",
+        {
+            "from": transfer.from_account_id,
+            "to": transfer.to_account_id,
+            "amount_from": float(amount_from),
+            "amount_to": float(amount_to),
+            "rate": rate,
+            "commission": float(commission_amount),
+        },
+        "success",
+        None,
+        ts=ts,
+    )
+
+    return TRANSFER_OUT_ADAPTER.validate_python(transfer, from_attributes=True)
 
 
 @app.get("/transfers/{transfer_id}", response_model=TransferOut)
@@ -409,7 +459,7 @@ async def get_transfer(
     if not a or a.owner_email != user:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    return TransferOut.model_validate(t)
+    return TRANSFER_OUT_ADAPTER.validate_python(t, from_attributes=True)
 
 
 @app.get("/rates")
@@ -427,5 +477,5 @@ async def get_rate(
         "quote": quote.upper(),
         "rate": rate,
         "provider": "mock" if rates.use_mock else "exchangerate.host",
-        "ts": datetime.utcnow().isoformat(),
+        "ts": datetime.now(timezone.utc).isoformat(),
     }
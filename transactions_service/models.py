@@ -1,6 +1,15 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, Numeric, Integer, DateTime, ForeignKey
+from sqlalchemy import (
+    String,
+    Numeric,
+    Integer,
+    DateTime,
+    ForeignKey,
+    Index,
+    func,
+)
 from datetime import datetime
+from decimal import Decimal
 from typing import Optional
 
 
@@ -10,10 +19,11 @@ class Base(DeclarativeBase):
 
 class Account(Base):
     __tablename__ = "accounts"
+    __table_args__ = (Index("ix_accounts_owner_id", "owner_email", "id"),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     owner_email: Mapped[str] = mapped_column(String(255), index=True)
     currency: Mapped[str] = mapped_column(String(10), index=True)
-    balance: Mapped[float] = mapped_column(Numeric(18, 2), default=0)
+    balance: Mapped[Decimal] = mapped_column(Numeric(18, 2), default=0)
     title: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
 
 
@@ -32,28 +42,34 @@ class Transfer(Base):
     # суммы и валюты
     currency_from: Mapped[str] = mapped_column(String(10))
     currency_to: Mapped[str] = mapped_column(String(10))
-    amount_from: Mapped[float] = mapped_column(Numeric(18, 2))
-    amount_to: Mapped[float] = mapped_column(Numeric(18, 2))
+    amount_from: Mapped[Decimal] = mapped_column(Numeric(18, 2))
+    amount_to: Mapped[Decimal] = mapped_column(Numeric(18, 2))
 
     # комиссии
-    commission_percent: Mapped[float] = mapped_column(Numeric(6, 3), default=0)
-    commission_fixed: Mapped[float] = mapped_column(Numeric(18, 2), default=0)
-    commission_amount: Mapped[float] = mapped_column(Numeric(18, 2), default=0)
+    commission_percent: Mapped[Decimal] = mapped_column(
+        Numeric(6, 3), default=0
+    )
+    commission_fixed: Mapped[Decimal] = mapped_column(
+        Numeric(18, 2), default=0
+    )
+    commission_amount: Mapped[Decimal] = mapped_column(
+        Numeric(18, 2), default=0
+    )
 
     # курс
-    rate_used: Mapped[float] = mapped_column(Numeric(18, 6), default=1)
+    rate_used: Mapped[Decimal] = mapped_column(Numeric(18, 6), default=1)
 
     # статусы: created, processing, completed, failed
     status: Mapped[str] = mapped_column(String(20), default="created")
 
     # идемпотентность (по желанию клиента)
     client_key: Mapped[Optional[str]] = mapped_column(
-        String(64), unique=True, nullable=True
+        String(64), unique=True, index=True, nullable=True
     )
 
     created_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow
+        DateTime(timezone=True), server_default=func.now()
     )
     updated_at: Mapped[datetime] = mapped_column(
-        DateTime, default=datetime.utcnow
+        DateTime(timezone=True), server_default=func.now()
     )
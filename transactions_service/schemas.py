@@ -1,4 +1,5 @@
-from pydantic import BaseModel, Field
+from decimal import Decimal
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Literal
 
 
@@ -7,9 +8,13 @@ class TransferCreate(BaseModel):
     from_account_id: int
     to_account_id: int
     mode: Literal["from", "to"]
-    amount: float = Field(gt=0)
-    commission_percent: float = 0.0
-    commission_fixed: float = 0.0
+    amount: Decimal = Field(gt=0, max_digits=18, decimal_places=2)
+    commission_percent: Decimal = Field(
+        Decimal("0.0"), ge=0, lt=100, max_digits=6, decimal_places=3
+    )
+    commission_fixed: Decimal = Field(
+        Decimal("0.0"), ge=0, max_digits=18, decimal_places=2
+    )
     client_key: str | None = None
 
 
@@ -25,5 +30,4 @@ class TransferOut(BaseModel):
     commission_amount: float
     rate_used: float
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
@@ -1,8 +1,21 @@
-import os, time, json, sqlite3, threading
-from datetime import datetime
+import os, sqlite3, asyncio, logging
+from datetime import datetime, timezone
 from typing import Optional, Any
 
-_LOCK = threading.Lock()
+import aiosqlite
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# фоновая выгрузка: запрос только кладёт запись в очередь
+AUDIT_QUEUE_MAX = 10_000
+AUDIT_BATCH_MAX = 256
+AUDIT_BATCH_WAIT = 0.05  # сек: сколько ждём добора пачки после первой записи
+_queue: Optional[asyncio.Queue] = None
+_flusher: Optional[asyncio.Task] = None
+_users = 0
+# одно долгоживущее соединение фоновой выгрузки (писатель один)
+_conn: Optional[aiosqlite.Connection] = None
 
 BASE_DIR = os.getenv(
     "DATA_DIR",
@@ -11,75 +24,137 @@ BASE_DIR = os.getenv(
 os.makedirs(BASE_DIR, exist_ok=True)
 _AUDIT_DB = os.path.join(BASE_DIR, "audit_log.sqlite")
 
-_INITIALIZED = False
+_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS audit_log(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts TEXT NOT NULL,
+        user_id TEXT,
+        operation_type TEXT,
+        operation_target TEXT,
+        details TEXT,
+        status TEXT,
+        error_message TEXT
+    )
+"""
+
+_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_audit_ts ON audit_log(ts)"
+
+# аудит — append-only и некритичен: меньше fsync, горячие страницы в mmap
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA wal_autocheckpoint=1000",
+)
 
 def _connect():
     # увеличим таймаут ожидания блокировки
     return sqlite3.connect(_AUDIT_DB, timeout=30)
 
-def _ensure_schema():
-    global _INITIALIZED
-    if _INITIALIZED:
-        return
-    with _LOCK:
-        if _INITIALIZED:
-            return
-        for attempt in range(10):
-            try:
-                with _connect() as conn:
-                    # можно включать WAL, но это тоже берёт lock — делаем аккуратно
-                    # conn.execute("PRAGMA journal_mode=WAL;")
-                    conn.execute("""
-                        CREATE TABLE IF NOT EXISTS audit_log(
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            ts TEXT NOT NULL,
-                            user_id TEXT,
-                            operation_type TEXT,
-                            operation_target TEXT,
-                            details TEXT,
-                            status TEXT,
-                            error_message TEXT
-                        )
-                    """)
-                    conn.commit()
-                    _INITIALIZED = True
-                    return
-            except sqlite3.OperationalError as e:
-                if "locked" in str(e).lower():
-                    time.sleep(0.3)
-                    continue
-                raise
-        # если прям совсем плохо — последний раз пробуем, иначе пусть падает
-        with _connect() as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS audit_log(
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ts TEXT NOT NULL,
-                    user_id TEXT,
-                    operation_type TEXT,
-                    operation_target TEXT,
-                    details TEXT,
-                    status TEXT,
-                    error_message TEXT
-                )
-            """)
-            conn.commit()
-        _INITIALIZED = True
+_INSERT_SQL = """
+    INSERT INTO audit_log(ts, user_id, operation_type, operation_target, details, status, error_message)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _insert(records: list[tuple]):
+    # синхронный путь — только вне lifespan, когда фоновой выгрузки нет
+    with _connect() as conn:
+        conn.execute(_SCHEMA_SQL)
+        conn.execute(_INDEX_SQL)
+        conn.executemany(_INSERT_SQL, records)
+        conn.commit()
+
+async def _open_conn() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(_AUDIT_DB, timeout=30)
+    # WAL + NORMAL: fsync только на чекпоинтах, читатели не блокируют запись
+    for pragma in _PRAGMAS:
+        await conn.execute(pragma)
+    # схема создаётся один раз при старте, а не на каждой записи
+    await conn.execute(_SCHEMA_SQL)
+    await conn.execute(_INDEX_SQL)
+    await conn.commit()
+    return conn
+
+async def _insert_async(conn: aiosqlite.Connection, records: list[tuple]):
+    await conn.executemany(_INSERT_SQL, records)
+    await conn.commit()
 
 def audit_write(user_id: Optional[str], operation_type: str,
                 operation_target: str, details: Any,
-                status: str, error_message: Optional[str] = None):
-    _ensure_schema()
+                status: str, error_message: Optional[str] = None,
+                ts: Optional[str] = None):
+    # ts — готовая ISO-метка, если вызывающий уже взял время запроса
     record = (
-        datetime.utcnow().isoformat(),
+        ts or datetime.now(timezone.utc).isoformat(),
         user_id, operation_type, operation_target,
-        json.dumps(details, ensure_ascii=False),
+        orjson.dumps(details).decode(),
         status, error_message
     )
-    with _LOCK:
-        with _connect() as conn:
-            conn.execute("""
-                INSERT INTO audit_log(ts, user_id, operation_type, operation_target, details, status, error_message)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, record)
-            conn.commit()
\ No newline at end of file
+    if _queue is None:
+        # фоновая выгрузка не запущена (вне lifespan) — пишем сразу
+        _insert([record])
+        return
+    try:
+        _queue.put_nowait(record)
+    except asyncio.QueueFull:
+        # очередь переполнена — жертвуем самой старой записью
+        _queue.get_nowait()
+        _queue.put_nowait(record)
+
+async def _flush_loop(queue: asyncio.Queue, conn: aiosqlite.Connection):
+    # None в очереди — сигнал остановки (после него записей нет)
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        batch = []
+        record = await queue.get()
+        deadline = loop.time() + AUDIT_BATCH_WAIT
+        # копим до AUDIT_BATCH_MAX записей или AUDIT_BATCH_WAIT секунд
+        while record is not None:
+            batch.append(record)
+            if len(batch) >= AUDIT_BATCH_MAX:
+                break
+            if not queue.empty():
+                record = queue.get_nowait()
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                record = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        done = record is None
+        if batch:
+            try:
+                await _insert_async(conn, batch)
+            except Exception as e:
+                logger.error(f"[audit] flush of {len(batch)} records failed: {e}")
+
+async def setup_audit():
+    """
+    Запуск фоновой выгрузки аудита (одна на процесс, даже если
+    в процессе несколько приложений — считаем пользователей).
+    """
+    global _queue, _flusher, _users, _conn
+    _users += 1
+    if _flusher is None:
+        _conn = await _open_conn()
+        _queue = asyncio.Queue(maxsize=AUDIT_QUEUE_MAX)
+        _flusher = asyncio.create_task(_flush_loop(_queue, _conn))
+
+async def shutdown_audit():
+    """
+    Остановка: дописываем всё, что осталось в очереди.
+    """
+    global _queue, _flusher, _users, _conn
+    _users -= 1
+    if _users > 0 or _flusher is None:
+        return
+    queue, flusher, conn = _queue, _flusher, _conn
+    _queue, _flusher, _conn = None, None, None
+    await queue.put(None)
+    await flusher
+    await conn.close()
+
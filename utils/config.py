@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
-from pydantic import Field, ValidationError
+from pydantic import Field, ValidationError, computed_field, field_validator
+from functools import cached_property
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent  # .../money_transfer/
@@ -15,8 +16,21 @@ class Settings(BaseSettings):
     )
 
     # Необязательные — с безопасными дефолтами
+    # пул соединений (за PgBouncer: db_pool_size=5, db_max_overflow=0)
+    db_pool_size: int = 20
+    db_max_overflow: int = 10
+    # кэш подготовленных выражений asyncpg; за PgBouncer (transaction
+    # pooling) prepared statements не переживают смену соединения — ставить 0
+    db_statement_cache_size: int = 1024
+
     jwt_alg: str = "HS256"
     jwt_expires_min: int = 300
+    jwt_cache_ttl: int = 5
+    jwt_cache_max: int = 10000
+
+    # кэш успешных проверок пароля (повторные логины без bcrypt)
+    password_cache_enabled: bool = True
+    password_cache_ttl: int = 10
 
     default_language: str = "en"
     supported_languages: str = "en,ru"
@@ -29,6 +43,25 @@ class Settings(BaseSettings):
     use_mock_rates: bool = True
     rates_provider_url: str = "https://api.exchangerate.host/latest"
 
+    @field_validator("db_url")
+    @classmethod
+    def _use_asyncpg(cls, v: str) -> str:
+        # Postgres всегда через asyncpg (кэш prepared statements)
+        scheme, sep, rest = v.partition("://")
+        if sep and scheme.split("+")[0] in ("postgres", "postgresql"):
+            return f"postgresql+asyncpg://{rest}"
+        return v
+
+    @computed_field
+    @cached_property
+    def supported_langs(self) -> frozenset[str]:
+        # разбираем supported_languages один раз, а не на каждом запросе
+        return frozenset(
+            lang.strip().lower()
+            for lang in self.supported_languages.split(",")
+            if lang.strip()
+        )
+
     model_config = SettingsConfigDict(
         env_file=str(ENV_FILE),
         extra="ignore",
@@ -5,7 +5,34 @@ from sqlalchemy.ext.asyncio import (
 )
 from .config import settings
 
-engine = create_async_engine(settings.db_url, echo=False, future=True)
+
+def engine_options(db_url: str) -> dict:
+    """
+    Параметры пула (и кэша выражений asyncpg) для create_async_engine.
+    Для SQLite пул подбирает сам SQLAlchemy — ничего не передаём.
+    """
+    if db_url.startswith("sqlite"):
+        return {}
+    options = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": 30,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    if db_url.startswith("postgresql+asyncpg"):
+        cache_size = settings.db_statement_cache_size
+        options["connect_args"] = {
+            "statement_cache_size": cache_size,
+            "prepared_statement_cache_size": cache_size,
+        }
+    return options
+
+
+# один движок (и один пул) на процесс — все сервисы берут его отсюда
+engine = create_async_engine(
+    settings.db_url, echo=False, future=True, **engine_options(settings.db_url)
+)
 SessionLocal = async_sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession
 )
@@ -1,6 +1,8 @@
 from babel.dates import format_datetime
 from babel.numbers import format_currency
 from datetime import datetime
+from decimal import Decimal
+from functools import lru_cache
 
 # простые словари переводов (добавлять по мере нужды)
 TRANSLATIONS = {
@@ -21,20 +23,34 @@ TRANSLATIONS = {
 }
 
 
+# таблица статична — раскладываем в плоский словарь один раз при импорте
+_FLAT = {
+    (key, lang): text
+    for key, values in TRANSLATIONS.items()
+    for lang, text in values.items()
+}
+_EN_FALLBACK = {
+    key: values.get("en", key) for key, values in TRANSLATIONS.items()
+}
+
+
 def t(key: str, lang: str = "en") -> str:
-    values = TRANSLATIONS.get(key)
-    if not values:
-        return key
-    return values.get(lang, values.get("en", key))
+    text = _FLAT.get((key, lang))
+    if text is None:
+        return _EN_FALLBACK.get(key, key)
+    return text
 
 
+@lru_cache(maxsize=8)
 def get_locale(lang: str) -> str:
     if lang.lower().startswith("ru"):
         return "ru_RU"
     return "en_US"
 
 
-def format_money(amount: float, currency: str, lang: str = "en") -> str:
+def format_money(
+    amount: Decimal | float, currency: str, lang: str = "en"
+) -> str:
     loc = get_locale(lang)
     return format_currency(amount, currency, locale=loc)
 
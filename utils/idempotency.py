@@ -1,13 +1,45 @@
 import uuid
-from fastapi import Request
-from starlette.responses import Response
-
-
-async def idempotency_middleware(request: Request, call_next):
-    idem = request.headers.get("X-Idempotency-Key")
-    if not idem:
-        idem = str(uuid.uuid4())
-    request.state.idem_key = idem
-    response: Response = await call_next(request)
-    response.headers["X-Idempotency-Key"] = idem
-    return response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+IDEM_HEADER = b"x-idempotency-key"
+# методы без побочных эффектов: ключ им не нужен, если клиент его не прислал
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+
+
+class IdempotencyMiddleware:
+    """
+    Чистый ASGI-middleware (без задачи и потоков BaseHTTPMiddleware):
+      - ключ берётся из X-Idempotency-Key или генерируется (uuid4)
+      - GET/HEAD/OPTIONS без ключа проходят как есть
+      - кладётся в request.state.idem_key
+      - возвращается в заголовке ответа
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        idem = None
+        for name, value in scope["headers"]:
+            if name == IDEM_HEADER:
+                idem = value
+                break
+        if idem is None:
+            if scope["method"] in SAFE_METHODS:
+                await self.app(scope, receive, send)
+                return
+            idem = str(uuid.uuid4()).encode("latin-1")
+        scope.setdefault("state", {})["idem_key"] = idem.decode("latin-1")
+
+        async def send_with_key(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((IDEM_HEADER, idem))
+                message["headers"] = headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_key)
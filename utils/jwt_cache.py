@@ -0,0 +1,59 @@
+import hashlib
+import threading
+import time
+from cachetools import TTLCache
+from jose import jwt
+from .config import settings
+
+JWT_KEY = settings.jwt_secret
+JWT_ALGS = (settings.jwt_alg,)
+# наши токены несут только sub и exp — остальные проверки не нужны
+JWT_DECODE_OPTS = {
+    "verify_signature": True,
+    "verify_exp": True,
+    "verify_nbf": False,
+    "verify_iat": False,
+    "verify_aud": False,
+    "verify_iss": False,
+    "verify_sub": False,
+    "verify_jti": False,
+    "verify_at_hash": False,
+    "require_aud": False,
+    "require_iss": False,
+}
+
+_LOCK = threading.Lock()
+# ключ — хэш токена, значение — (sub, exp)
+_cache: TTLCache = TTLCache(
+    maxsize=settings.jwt_cache_max, ttl=settings.jwt_cache_ttl
+)
+
+
+def _key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def decode_sub(token: str) -> str | None:
+    """
+    Возвращает sub из JWT, проверяя подпись только при промахе кэша.
+    exp проверяется и на попадании, так что истёкший токен не пройдёт.
+    Ошибки валидации — JWTError, как у jwt.decode.
+    """
+    key = _key(token)
+    with _LOCK:
+        hit = _cache.get(key)
+    if hit is not None:
+        sub, exp = hit
+        if exp is None or exp > time.time():
+            return sub
+        with _LOCK:
+            _cache.pop(key, None)
+
+    payload = jwt.decode(
+        token, JWT_KEY, algorithms=JWT_ALGS, options=JWT_DECODE_OPTS
+    )
+    sub = payload.get("sub")
+    if sub:
+        with _LOCK:
+            _cache[key] = (sub, payload.get("exp"))
+    return sub
@@ -1,10 +1,17 @@
+import hashlib
+import os
 from datetime import datetime, timedelta
+from cachetools import TTLCache
 from jose import jwt
 from passlib.context import CryptContext
 from .config import settings
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# ключ на процесс: дайджесты в кэше нельзя перебрать офлайн
+_PW_CACHE_SECRET = os.urandom(16)
+_pw_cache: TTLCache = TTLCache(maxsize=1024, ttl=settings.password_cache_ttl)
+
 
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
@@ -14,6 +21,26 @@ def verify_password(password: str, hashed: str) -> bool:
     return pwd_context.verify(password, hashed)
 
 
+def verify_password_cached(email: str, password: str, hashed: str) -> bool:
+    """
+    verify_password с коротким TTL-кэшем успешных проверок.
+    Неудачи не кэшируются; смена хэша даёт новый ключ.
+    """
+    if not settings.password_cache_enabled:
+        return verify_password(password, hashed)
+    key = hashlib.blake2b(
+        b"\x00".join((email.encode(), password.encode(), hashed.encode())),
+        digest_size=16,
+        key=_PW_CACHE_SECRET,
+    ).digest()
+    if key in _pw_cache:
+        return True
+    ok = verify_password(password, hashed)
+    if ok:
+        _pw_cache[key] = True
+    return ok
+
+
 def create_access_token(sub: str) -> str:
     expire = datetime.utcnow() + timedelta(minutes=settings.jwt_expires_min)
     payload = {"sub": sub, "exp": expire}
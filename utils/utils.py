@@ -1,7 +1,35 @@
+from functools import lru_cache
 from fastapi import Request
 from .config import settings
 
+_SUPPORTED = settings.supported_langs
+_DEFAULT = (
+    settings.default_language.lower()
+    if settings.default_language.lower() in _SUPPORTED
+    else "en"
+)
+
+
+@lru_cache(maxsize=1024)
+def _parse_accept_language(header: str) -> str:
+    # "ru-RU,ru;q=0.9,en;q=0.8" -> поддерживаемый язык с наибольшим q
+    best, best_q = _DEFAULT, 0.0
+    for part in header.split(","):
+        tag, _, params = part.partition(";")
+        lang = tag.strip().split("-")[0].lower()
+        if lang not in _SUPPORTED:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        if q > best_q:
+            best, best_q = lang, q
+    return best
+
 
 def get_lang(request: Request) -> str:
-    accept = request.headers.get("Accept-Language", settings.default_language)
-    return "ru" if accept.lower().startswith("ru") else "en"
+    return _parse_accept_language(request.headers.get("Accept-Language", ""))